@@ -51,11 +51,19 @@ class Config(metaclass=_ParamsAsProps):
         "smtp_password": None,
         "smtp_password_command": None,
         "smtp_timeout": 10,
+        "smtp_relays": None,
+        "smtp_relay_backoff": 30,
+        "smtp_relay_state_file": None,
         "css_file": None,
         "sendmail": "/usr/sbin/sendmail",
         "assume_markdown": False,
+        "metrics_file": None,
+        "max_mime_depth": 100,
+        "max_mime_parts": 20000,
     }
 
+    _relay_parameters = ("host", "port", "weight", "priority")
+
     def __init__(self):
         self._config = copy.copy(self._parameters)
         self._css = None
@@ -71,6 +79,8 @@ class Config(metaclass=_ParamsAsProps):
                 self._config[key] = d[key]
         if self._config["smtp_password"] and self._config["smtp_password_command"]:
             raise ConfigError("Cannot set smtp_password *and* smtp_password_command")
+        if self._config["smtp_relays"] is not None:
+            self._check_relays(self._config["smtp_relays"])
         if self._config["css_file"]:
             self._css = None
             self._config["css_file"] = os.path.expanduser(self._config["css_file"])
@@ -79,6 +89,30 @@ class Config(metaclass=_ParamsAsProps):
                     "CSS file %s does not exist" % self._config["css_file"]
                 )
 
+    def _check_relays(self, relays):
+        if not isinstance(relays, list) or not relays:
+            raise ConfigError("smtp_relays must be a non-empty list")
+        for relay in relays:
+            if not isinstance(relay, dict) or not relay.get("host"):
+                raise ConfigError("Every entry in smtp_relays must have a host")
+            invalid_keys = set(relay.keys()) - set(self._relay_parameters)
+            if invalid_keys:
+                raise ConfigError(
+                    "Unexpected smtp_relays keys: %s" % ", ".join(sorted(invalid_keys))
+                )
+            for key in ("port", "priority"):
+                value = relay.get(key, 0)
+                if not isinstance(value, int) or isinstance(value, bool):
+                    raise ConfigError(
+                        "%s for SMTP relay %s must be an integer"
+                        % (key.capitalize(), relay["host"])
+                    )
+            weight = relay.get("weight", 1)
+            if not isinstance(weight, (int, float)) or weight <= 0:
+                raise ConfigError(
+                    "Weight for SMTP relay %s must be positive" % relay["host"]
+                )
+
     def load(self, fobj):
         d = yaml.safe_load(fobj)
         self.merge_config(d)
@@ -103,3 +137,20 @@ class Config(metaclass=_ParamsAsProps):
             ).rstrip("\n")
         else:
             return self._config["smtp_password"]
+
+    @property
+    def smtp_relays(self):
+        """The SMTP relays to deliver to, as a list of dicts with host,
+        port, weight and priority keys. Defaults to just smtp_host."""
+        relays = self._config["smtp_relays"]
+        if relays is None:
+            relays = [{"host": self._config["smtp_host"]}]
+        return [
+            {
+                "host": r["host"],
+                "port": r.get("port", self._config["smtp_port"]),
+                "weight": r.get("weight", 1),
+                "priority": r.get("priority", 0),
+            }
+            for r in relays
+        ]
@@ -6,13 +6,14 @@ import re
 import smtplib
 import subprocess
 import sys
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
 import markdown
 import pynliner
 
-from . import __version__, config
+from . import __version__, config, metrics, relays
 
 __name__ = "muttdown"
 
@@ -43,118 +44,326 @@ def convert_one(part, config, charset):
         if not text.startswith("!m"):
             return None
         text = re.sub(r"\s*!m\s*", "", text, re.M)
-    if "\n-- \n" in text:
-        pre_signature, signature = text.split("\n-- \n")
-        md = markdown.markdown(
-            pre_signature, extensions=["extra"], output_format="html5"
-        )
-        md += '\n<div class="signature" style="font-size: small"><p>-- <br />'
-        md += "<br />".join(signature.split("\n"))
-        md += "</p></div>"
-    else:
-        md = markdown.markdown(text, extensions=["extra"])
+    with metrics.timed("conversion"):
+        if "\n-- \n" in text:
+            pre_signature, signature = text.split("\n-- \n")
+            md = markdown.markdown(
+                pre_signature, extensions=["extra"], output_format="html5"
+            )
+            md += '\n<div class="signature" style="font-size: small"><p>-- <br />'
+            md += "<br />".join(signature.split("\n"))
+            md += "</p></div>"
+        else:
+            md = markdown.markdown(text, extensions=["extra"])
     if config.css:
-        md = "<style>" + config.css + "</style>" + md
-        md = pynliner.fromString(md)
+        with metrics.timed("css_inlining"):
+            md = "<style>" + config.css + "</style>" + md
+            md = pynliner.fromString(md)
     message = MIMEText(md, "html", _charset="UTF-8")
     return message
 
 
 def _move_headers(source, dest):
-    for k, v in source.items():
+    """Move every header except Content-* and MIME-* from source to dest.
+
+    This is a single pass over the header list which keeps the original
+    order and any repeated headers (e.g. Received); deleting by name instead
+    rescans the whole list for each header moved.
+    """
+    kept = []
+    for k, v in source._headers:
         # mutt sometimes sticks in a fake bcc header
         if k.lower() == "bcc":
-            del source[k]
-        elif not (k.startswith("Content-") or k.startswith("MIME")):
-            dest.add_header(k, v)
-            del source[k]
+            continue
+        elif k.startswith("Content-") or k.startswith("MIME"):
+            kept.append((k, v))
+        else:
+            dest.add_header(k, source.policy.header_fetch_parse(k, v))
+    source._headers = kept
+
+
+def _convert_leaf(message, config, wrap_alternative, charset):
+    converted = None
+    disposition = message.get("Content-Disposition", "inline")
+    if disposition == "inline" and message.get_content_type() in (
+        "text/plain",
+        "text/markdown",
+    ):
+        converted = convert_one(message, config, charset)
+    if converted is not None:
+        metrics.inc("muttdown_parts", action="converted")
+        if wrap_alternative:
+            new_tree = MIMEMultipart("alternative")
+            _move_headers(message, new_tree)
+            new_tree.attach(message)
+            new_tree.attach(converted)
+            return new_tree, True
+        else:
+            return converted, True
+    metrics.inc("muttdown_parts", action="passthrough")
+    return message, False
 
 
-def convert_tree(message, config, indent=0, wrap_alternative=True, charset=None):
-    """Recursively convert a potentially-multipart tree.
+class _MultipartFrame(object):
+    """A multipart container on the convert_tree work stack, along with
+    the replacement container its converted children get attached to"""
+
+    def __init__(self, message, charset):
+        self.message = message
+        self.charset = charset
+        self.signed = message.get_content_type() == "multipart/signed"
+        if self.signed:
+            # if this is a multipart/signed message, then let's just
+            # convert the non-signature part
+            self.new_root = MIMEMultipart("alternative")
+        else:
+            self.new_root = MIMEMultipart(
+                message.get_content_subtype(), message.get_charset()
+            )
+        if message.preamble:
+            self.new_root.preamble = message.preamble
+        _move_headers(message, self.new_root)
+        self.did_conversion = False
+        self._parts = iter(message.get_payload())
+
+    def next_part(self):
+        for part in self._parts:
+            if self.signed and part.get_content_type() == "application/pgp-signature":
+                continue
+            return part
+        return None
+
+    def add_result(self, part, did_conversion):
+        if self.signed:
+            self.did_conversion = did_conversion
+            if did_conversion:
+                self.new_root.attach(part)
+        else:
+            self.did_conversion |= did_conversion
+            self.new_root.attach(part)
+
+    def finish(self):
+        if self.signed:
+            self.new_root.attach(self.message)
+        return self.new_root, self.did_conversion
+
+
+def _exceeds_limits(message, config):
+    max_depth = config.max_mime_depth
+    max_parts = config.max_mime_parts
+    parts = 0
+    stack = [(message, 0)]
+    while stack:
+        part, depth = stack.pop()
+        parts += 1
+        if max_parts is not None and parts > max_parts:
+            return True
+        if max_depth is not None and depth > max_depth:
+            return True
+        if part.is_multipart():
+            stack.extend((p, depth + 1) for p in part.get_payload())
+    return False
+
+
+def convert_tree(message, config, wrap_alternative=True, charset=None):
+    """Convert a potentially-multipart tree.
+
+    The tree is walked with an explicit stack instead of recursion, so deeply
+    nested messages can't hit the interpreter's recursion limit. Messages
+    nested deeper than max_mime_depth or with more than max_mime_parts parts
+    are passed through unchanged.
 
     Returns a tuple of (the converted tree, whether any markdown was found)
     """
-    ct = message.get_content_type()
-    cs = message.get_content_subtype()
+    if _exceeds_limits(message, config):
+        metrics.inc("muttdown_oversized_messages")
+        return message, False
     if charset is None:
         charset = get_charset_from_message_fragment(message)
     if not message.is_multipart():
-        # we're on a leaf
-        converted = None
-        disposition = message.get("Content-Disposition", "inline")
-        if disposition == "inline" and ct in ("text/plain", "text/markdown"):
-            converted = convert_one(message, config, charset)
-        if converted is not None:
-            if wrap_alternative:
-                new_tree = MIMEMultipart("alternative")
-                _move_headers(message, new_tree)
-                new_tree.attach(message)
-                new_tree.attach(converted)
-                return new_tree, True
-            else:
-                return converted, True
-        return message, False
-    else:
-        if ct == "multipart/signed":
-            # if this is a multipart/signed message, then let's just
-            # recurse into the non-signature part
-            new_root = MIMEMultipart("alternative")
-            if message.preamble:
-                new_root.preamble = message.preamble
-            _move_headers(message, new_root)
-            converted = None
-            for part in message.get_payload():
-                if part.get_content_type() != "application/pgp-signature":
-                    converted, did_conversion = convert_tree(
-                        part,
-                        config,
-                        indent=indent + 1,
-                        wrap_alternative=False,
-                        charset=charset,
-                    )
-                    if did_conversion:
-                        new_root.attach(converted)
-            new_root.attach(message)
-            return new_root, did_conversion
+        return _convert_leaf(message, config, wrap_alternative, charset)
+    stack = [_MultipartFrame(message, charset)]
+    while True:
+        frame = stack[-1]
+        part = frame.next_part()
+        if part is None:
+            stack.pop()
+            result = frame.finish()
+            if not stack:
+                return result
+            stack[-1].add_result(*result)
+            continue
+        part_charset = frame.charset
+        if part_charset is None:
+            part_charset = get_charset_from_message_fragment(part)
+        if part.is_multipart():
+            stack.append(_MultipartFrame(part, part_charset))
         else:
-            did_conversion = False
-            new_root = MIMEMultipart(cs, message.get_charset())
-            if message.preamble:
-                new_root.preamble = message.preamble
-            _move_headers(message, new_root)
-            for part in message.get_payload():
-                part, did_this_conversion = convert_tree(
-                    part, config, indent=indent + 1, charset=charset
+            frame.add_result(
+                *_convert_leaf(
+                    part,
+                    config,
+                    wrap_alternative=not frame.signed,
+                    charset=part_charset,
                 )
-                did_conversion |= did_this_conversion
-                new_root.attach(part)
-            return new_root, did_conversion
+            )
+
+
+def _strip_bcc(text):
+    """Remove any Bcc headers from the top of a raw message"""
+    end = re.search(r"\r?\n\r?\n", text)
+    split = end.start() if end is not None else len(text)
+    headers, body = text[:split], text[split:]
+    kept = []
+    in_bcc = False
+    for line in headers.splitlines(True):
+        if line[:1] in (" ", "\t"):
+            # a continuation of the previous header
+            if not in_bcc:
+                kept.append(line)
+        else:
+            in_bcc = line.lower().startswith("bcc:")
+            if not in_bcc:
+                kept.append(line)
+    return "".join(kept) + body
 
 
 def process_message(mail, config):
+    metrics.inc("muttdown_messages")
     converted, did_any_markdown = convert_tree(mail, config)
     if "Bcc" in converted:
         del converted["Bcc"]
     return converted
 
 
-def smtp_connection(c):
-    """Create an SMTP connection from a Config object"""
+def smtp_connection(c, relay=None, timeout=None):
+    """Create an SMTP connection from a Config object
+
+    Connects to `relay` (by default, the first configured relay) and
+    records the connect latency on it."""
+    if relay is None:
+        relay = relays.Relay(**c.smtp_relays[0])
+    if timeout is None:
+        timeout = c.smtp_timeout
     if c.smtp_ssl:
         klass = smtplib.SMTP_SSL
     else:
         klass = smtplib.SMTP
-    conn = klass(c.smtp_host, c.smtp_port, timeout=c.smtp_timeout)
-    if not c.smtp_ssl:
-        conn.ehlo()
-        conn.starttls()
-        conn.ehlo()
-    if c.smtp_username:
-        conn.login(c.smtp_username, c.smtp_password)
+    start = time.monotonic()
+    conn = None
+    try:
+        with metrics.timed("smtp_connect"):
+            conn = klass(relay.host, relay.port, timeout=timeout)
+            if not c.smtp_ssl:
+                conn.ehlo()
+                conn.starttls()
+                conn.ehlo()
+        relay.record_latency(time.monotonic() - start)
+        if c.smtp_username:
+            with metrics.timed("smtp_auth"):
+                conn.login(c.smtp_username, c.smtp_password)
+    except BaseException:
+        # don't leak the socket when we fail over to another relay
+        if conn is not None:
+            conn.close()
+        raise
     return conn
 
 
+def _should_fail_over(exc, connected):
+    """Whether another relay might succeed where this error happened
+
+    Once connected, only explicit 4xx replies are safe to retry elsewhere: a
+    network error after DATA may come after the relay accepted the message,
+    and sending it again would deliver it twice."""
+    if isinstance(exc, smtplib.SMTPConnectError):
+        return True
+    elif isinstance(exc, smtplib.SMTPResponseException):
+        return 400 <= exc.smtp_code < 500
+    elif isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return bool(exc.recipients) and all(
+            400 <= code < 500 for code, _ in exc.recipients.values()
+        )
+    # smtplib.SMTPException is an OSError too
+    return not connected and isinstance(exc, OSError)
+
+
+def send_smtp(c, from_addr, to_addrs, msg, pool=None):
+    """Send `msg` through the healthiest configured SMTP relay, failing over
+    to the next one on connection errors and 4xx responses for as long as
+    smtp_timeout allows."""
+    if pool is None:
+        pool = relays.RelayPool.from_config(c)
+    try:
+        deadline = time.monotonic() + c.smtp_timeout
+        candidates = pool.candidates()
+        last_error = None
+        for i, relay in enumerate(candidates):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if last_error is not None:
+                metrics.inc("muttdown_smtp_failovers")
+            conn = None
+            # split what's left of the timeout among the remaining relays
+            # so that one hung relay can't use all of it
+            connect_timeout = remaining / (len(candidates) - i)
+            try:
+                conn = smtp_connection(c, relay, timeout=connect_timeout)
+                # but once connected, give the transaction all the time left
+                # so that a relay slow to accept the message isn't abandoned
+                conn.sock.settimeout(max(deadline - time.monotonic(), connect_timeout))
+                with metrics.timed("smtp_data"):
+                    conn.sendmail(from_addr, to_addrs, msg)
+            except Exception as e:
+                metrics.inc(
+                    "muttdown_delivery_errors", method="smtp", code=_smtp_error_code(e)
+                )
+                if conn is not None:
+                    conn.close()
+                if not _should_fail_over(e, connected=conn is not None):
+                    raise
+                pool.record_failure(relay)
+                last_error = e
+                continue
+            relay.record_success()
+            conn.quit()
+            return relay
+        if last_error is None:
+            raise smtplib.SMTPException(
+                "No SMTP relay could be tried within smtp_timeout"
+            )
+        raise last_error
+    finally:
+        if c.smtp_relay_state_file:
+            pool.save_state(c.smtp_relay_state_file)
+
+
+def _smtp_error_code(exc):
+    """Pick a metrics label for an exception raised while talking SMTP"""
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return str(exc.smtp_code)
+    elif isinstance(exc, smtplib.SMTPRecipientsRefused) and exc.recipients:
+        return str(sorted(exc.recipients.values())[0][0])
+    elif isinstance(exc, smtplib.SMTPServerDisconnected):
+        return "disconnected"
+    elif isinstance(exc, (OSError, smtplib.SMTPException)):
+        return "network"
+    return "other"
+
+
+def write_metrics(c):
+    if not c.metrics_file:
+        return
+    try:
+        metrics.write_textfile(c.metrics_file)
+    except Exception as e:
+        # metrics are best-effort; never let them change the exit status
+        # of a delivery that has already happened
+        sys.stderr.write("Unable to write metrics to %s: %s\n" % (c.metrics_file, e))
+        sys.stderr.flush()
+
+
 def read_message():
     return sys.stdin.read()
 
@@ -197,31 +406,58 @@ def main(argv=None):
         sys.stderr.flush()
         return 1
 
+    try:
+        return _deliver(args, c)
+    finally:
+        write_metrics(c)
+
+
+def _deliver(args, c):
     message = read_message()
+    metrics.inc("muttdown_bytes", len(message.encode("utf-8")), direction="in")
 
     mail = email.message_from_string(message)
 
-    rebuilt = process_message(mail, c)
-    rebuilt.set_unixfrom(args.envelope_from)
+    if _exceeds_limits(mail, c):
+        # the email package may not be able to serialize a tree this deep,
+        # so send exactly what we were given (minus the Bcc) instead
+        metrics.inc("muttdown_messages")
+        metrics.inc("muttdown_oversized_messages")
+        msg = _strip_bcc(message)
+    else:
+        rebuilt = process_message(mail, c)
+        rebuilt.set_unixfrom(args.envelope_from)
+        msg = rebuilt.as_string()
 
     if args.print_message:
-        print(rebuilt.as_string())
+        metrics.inc("muttdown_bytes", len(msg.encode("utf-8")), direction="out")
+        print(msg)
     elif args.sendmail_passthru:
         cmd = c.sendmail.split() + ["-f", args.envelope_from] + args.addresses
 
-        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, shell=False)
-        msg = rebuilt.as_string()
         msg = msg.encode("utf-8")
-        proc.stdin.write(msg)
-        proc.stdin.close()
-        proc.wait()
+        with metrics.timed("sendmail"):
+            try:
+                proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, shell=False)
+                # communicate() tolerates a sendmail that exits without
+                # reading the whole message; its exit status says why
+                proc.communicate(msg)
+            except OSError:
+                metrics.inc("muttdown_delivery_errors", method="sendmail", code="exec")
+                raise
+        if proc.returncode != 0:
+            metrics.inc(
+                "muttdown_delivery_errors",
+                method="sendmail",
+                code=str(proc.returncode),
+            )
+        else:
+            metrics.inc("muttdown_bytes", len(msg), direction="out")
         return proc.returncode
     else:
-        conn = smtp_connection(c)
-        msg = rebuilt.as_string()
         msg = msg.encode("utf-8")
-        conn.sendmail(args.envelope_from, args.addresses, msg)
-        conn.quit()
+        send_smtp(c, args.envelope_from, args.addresses, msg)
+        metrics.inc("muttdown_bytes", len(msg), direction="out")
     return 0
 
 
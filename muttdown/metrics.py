@@ -0,0 +1,255 @@
+import contextlib
+import json
+import os
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:  # no flock on Windows
+    fcntl = None
+
+# Cumulative counters and latency histograms, exported in the Prometheus
+# text format so that node-exporter's textfile collector can pick them up.
+#
+# Every muttdown invocation records into the in-process registry; when a
+# metrics_file is configured, the registry is merged into a lock-protected
+# JSON state file next to it and the textfile is rewritten atomically.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = {
+    "muttdown_messages": ("counter", "Messages processed"),
+    "muttdown_parts": ("counter", "Leaf MIME parts, by whether they were converted"),
+    "muttdown_oversized_messages": (
+        "counter",
+        "Messages passed through unchanged for exceeding max_mime_depth or max_mime_parts",
+    ),
+    "muttdown_bytes": ("counter", "Message bytes read and written"),
+    "muttdown_stage_duration_seconds": ("histogram", "Time spent in each stage"),
+    "muttdown_delivery_errors": ("counter", "Delivery failures, by method and code"),
+    "muttdown_smtp_failovers": ("counter", "Retries of a send on another SMTP relay"),
+}
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_bound(bound):
+    if bound == float("inf"):
+        return "+Inf"
+    return repr(float(bound))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"'
+        % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+
+
+class Registry(object):
+    """In-process store of counters and histograms."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _labels_key(labels))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels_key(labels))
+        if key not in self.histograms:
+            self.histograms[key] = {
+                "buckets": [0] * len(self.buckets),
+                "sum": 0.0,
+                "count": 0,
+            }
+        h = self.histograms[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                h["buckets"][i] += 1
+        h["sum"] += value
+        h["count"] += 1
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(
+                "muttdown_stage_duration_seconds",
+                time.monotonic() - start,
+                stage=stage,
+            )
+
+    def merge(self, other):
+        for key, value in other.counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, h in other.histograms.items():
+            if key not in self.histograms:
+                self.histograms[key] = {
+                    "buckets": [0] * len(self.buckets),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            mine = self.histograms[key]
+            mine["buckets"] = [a + b for a, b in zip(mine["buckets"], h["buckets"])]
+            mine["sum"] += h["sum"]
+            mine["count"] += h["count"]
+
+    def to_state(self):
+        return {
+            "buckets": [_format_bound(b) for b in self.buckets],
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self.counters.items()
+            ],
+            "histograms": [
+                dict(h, name=name, labels=dict(labels))
+                for (name, labels), h in self.histograms.items()
+            ],
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """Rebuild a registry from to_state() output; malformed state is
+        discarded and yields an empty registry."""
+        self = cls()
+        try:
+            if state.get("buckets") != [_format_bound(b) for b in self.buckets]:
+                # bucket layout changed; the old histograms can't be merged
+                state = dict(state, histograms=[])
+            for c in state.get("counters", []):
+                self.counters[(c["name"], _labels_key(c["labels"]))] = c["value"] + 0
+            for h in state.get("histograms", []):
+                if len(h["buckets"]) != len(self.buckets):
+                    raise ValueError("wrong number of buckets")
+                self.histograms[(h["name"], _labels_key(h["labels"]))] = {
+                    "buckets": [int(b) for b in h["buckets"]],
+                    "sum": h["sum"] + 0.0,
+                    "count": int(h["count"]),
+                }
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return cls()
+        return self
+
+    def render(self):
+        """Render the registry in the Prometheus text exposition format"""
+        lines = []
+        for family, (kind, help_text) in METRICS.items():
+            if kind == "counter":
+                # the Prometheus parser only types samples whose name matches
+                # the TYPE line exactly, so declare counters with the suffix
+                sample_name = family + "_total"
+                lines.append("# HELP %s %s." % (sample_name, help_text))
+                lines.append("# TYPE %s %s" % (sample_name, kind))
+                for (name, labels), value in sorted(self.counters.items()):
+                    if name == family:
+                        lines.append(
+                            "%s%s %s"
+                            % (
+                                sample_name,
+                                _format_labels(labels),
+                                _format_value(value),
+                            )
+                        )
+            else:
+                lines.append("# HELP %s %s." % (family, help_text))
+                lines.append("# TYPE %s %s" % (family, kind))
+                for (name, labels), h in sorted(self.histograms.items()):
+                    if name != family:
+                        continue
+                    for bound, count in zip(self.buckets, h["buckets"]):
+                        bucket_labels = labels + (("le", _format_bound(bound)),)
+                        lines.append(
+                            "%s_bucket%s %d"
+                            % (family, _format_labels(bucket_labels), count)
+                        )
+                    lines.append(
+                        "%s_sum%s %s"
+                        % (family, _format_labels(labels), _format_value(h["sum"]))
+                    )
+                    lines.append(
+                        "%s_count%s %d" % (family, _format_labels(labels), h["count"])
+                    )
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def inc(name, amount=1, **labels):
+    registry.inc(name, amount, **labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+def timed(stage):
+    return registry.timed(stage)
+
+
+def write_textfile(path, source=None):
+    """Merge `source` (by default the in-process registry) into the
+    cumulative state kept next to `path` and atomically rewrite `path`.
+
+    The in-process registry is cleared afterwards, so calling this more
+    than once from a long-running process never double-counts."""
+    if source is None:
+        source = registry
+    path = os.path.expanduser(path)
+    state_path = path + ".json"
+    with open(state_path, "a+") as state_file:
+        if fcntl is not None:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+        try:
+            state_file.seek(0)
+            try:
+                state = json.loads(state_file.read() or "{}")
+            except ValueError:
+                # start over rather than failing on every run from now on
+                state = {}
+            total = Registry.from_state(state)
+            total.merge(source)
+            state_file.seek(0)
+            state_file.truncate()
+            json.dump(total.to_state(), state_file)
+            state_file.flush()
+
+            # the textfile collector may read at any time, so never leave a
+            # partially-written file in place
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(path)), prefix=".muttdown-"
+            )
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.write(total.render())
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        finally:
+            if fcntl is not None:
+                fcntl.flock(state_file, fcntl.LOCK_UN)
+    source.reset()
+    return total
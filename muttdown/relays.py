@@ -0,0 +1,194 @@
+import json
+import math
+import os
+import random
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError:  # no flock on Windows
+    fcntl = None
+
+# Health tracking and ordering for the configured SMTP relays.
+#
+# Relays are tried by ascending priority (like MX records). Within a
+# priority, they're shuffled by weight scaled by health, which falls with
+# recent connect latency and error rate. A relay that fails is backed off
+# from for smtp_relay_backoff seconds, doubling with each consecutive
+# failure; it is only tried again early if every other relay has failed.
+
+EWMA_ALPHA = 0.3
+# connect latency (in seconds) which halves a relay's share of traffic
+LATENCY_SCALE = 0.25
+MIN_HEALTH = 0.01
+MAX_BACKOFF = 600
+
+
+def _is_number(value):
+    return (
+        isinstance(value, (int, float))
+        and not isinstance(value, bool)
+        and math.isfinite(value)
+    )
+
+
+class Relay(object):
+    def __init__(self, host, port, weight=1, priority=0):
+        self.host = host
+        self.port = port
+        self.weight = weight
+        self.priority = priority
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.backoff_until = 0
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__.__name__, self.host, self.port)
+
+    @property
+    def key(self):
+        return "%s:%s" % (self.host, self.port)
+
+    @property
+    def health(self):
+        health = 1.0 - self.error_rate
+        if self.latency is not None:
+            health /= 1.0 + self.latency / LATENCY_SCALE
+        return max(health, MIN_HEALTH)
+
+    def record_latency(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += EWMA_ALPHA * (latency - self.latency)
+
+    def record_success(self):
+        self.error_rate *= 1 - EWMA_ALPHA
+        self.failures = 0
+        self.backoff_until = 0
+
+    def record_failure(self, now, backoff):
+        self.error_rate += EWMA_ALPHA * (1.0 - self.error_rate)
+        self.failures += 1
+        # cap the exponent; failures persist across runs and can grow forever
+        exponent = min(self.failures - 1, 10)
+        self.backoff_until = now + min(backoff * 2**exponent, MAX_BACKOFF)
+
+    def to_state(self):
+        return {
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+            "failures": self.failures,
+            "backoff_until": self.backoff_until,
+        }
+
+    def load_state(self, state):
+        """Restore to_state() output; an entry with any malformed field is
+        ignored and the relay keeps its defaults."""
+        latency = state.get("latency")
+        error_rate = state.get("error_rate", 0.0)
+        failures = state.get("failures", 0)
+        backoff_until = state.get("backoff_until", 0)
+        if not (
+            (latency is None or (_is_number(latency) and latency >= 0))
+            and _is_number(error_rate)
+            and 0 <= error_rate <= 1
+            and isinstance(failures, int)
+            and not isinstance(failures, bool)
+            and failures >= 0
+            and _is_number(backoff_until)
+        ):
+            return
+        self.latency = latency
+        self.error_rate = float(error_rate)
+        self.failures = failures
+        self.backoff_until = backoff_until
+
+
+class RelayPool(object):
+    def __init__(self, relays, backoff=30, rng=None, clock=time.time):
+        self.relays = relays
+        self.backoff = backoff
+        self.rng = rng if rng is not None else random.Random()
+        self.clock = clock
+
+    @classmethod
+    def from_config(cls, c):
+        pool = cls([Relay(**r) for r in c.smtp_relays], backoff=c.smtp_relay_backoff)
+        if c.smtp_relay_state_file:
+            pool.load_state(c.smtp_relay_state_file)
+        return pool
+
+    def _weighted_order(self, relays):
+        relays = list(relays)
+        ordered = []
+        while relays:
+            weights = [r.weight * r.health for r in relays]
+            pick = self.rng.random() * sum(weights)
+            for i, weight in enumerate(weights):
+                pick -= weight
+                if pick < 0:
+                    break
+            ordered.append(relays.pop(i))
+        return ordered
+
+    def candidates(self):
+        """Return every relay, in the order they should be tried"""
+        now = self.clock()
+        ready = [r for r in self.relays if r.backoff_until <= now]
+        ordered = []
+        for priority in sorted(set(r.priority for r in ready)):
+            ordered.extend(
+                self._weighted_order(r for r in ready if r.priority == priority)
+            )
+        # relays we're backing off from are a last resort, soonest-ready first
+        ordered.extend(
+            sorted(
+                (r for r in self.relays if r.backoff_until > now),
+                key=lambda r: r.backoff_until,
+            )
+        )
+        return ordered
+
+    def record_failure(self, relay):
+        relay.record_failure(self.clock(), self.backoff)
+
+    def load_state(self, path):
+        path = os.path.expanduser(path)
+        try:
+            with open(path, "r") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_SH)
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(state, dict):
+            return
+        for relay in self.relays:
+            if isinstance(state.get(relay.key), dict):
+                relay.load_state(state[relay.key])
+
+    def save_state(self, path):
+        path = os.path.expanduser(path)
+        try:
+            with open(path, "a+") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or "{}")
+                except ValueError:
+                    state = {}
+                if not isinstance(state, dict):
+                    state = {}
+                for relay in self.relays:
+                    state[relay.key] = relay.to_state()
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+        except OSError as e:
+            # relay health is only a hint; don't fail a send over it
+            sys.stderr.write("Unable to save SMTP relay state to %s: %s\n" % (path, e))
+            sys.stderr.flush()
@@ -0,0 +1,14 @@
+import shutil
+import tempfile
+
+import pytest
+
+
+@pytest.fixture
+def tempdir():
+    # workaround because pytest's bultin tmpdir fixture is broken on python 3.3
+    dirname = tempfile.mkdtemp()
+    try:
+        yield dirname
+    finally:
+        shutil.rmtree(dirname)
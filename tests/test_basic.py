@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import email.message
+import json
 import os
+import random
 import select
-import shutil
+import smtplib
 import socket
 import ssl
 import sys
-import tempfile
 import threading
 import time
 from email.message import Message
@@ -20,7 +21,8 @@ import yaml
 
 from muttdown import main
 from muttdown.config import Config
-from muttdown.main import convert_tree, process_message
+from muttdown.main import _move_headers, convert_tree, process_message
+from muttdown.relays import Relay, RelayPool
 
 
 @pytest.fixture
@@ -28,16 +30,6 @@ def basic_config():
     return Config()
 
 
-@pytest.fixture
-def tempdir():
-    # workaround because pytest's bultin tmpdir fixture is broken on python 3.3
-    dirname = tempfile.mkdtemp()
-    try:
-        yield dirname
-    finally:
-        shutil.rmtree(dirname)
-
-
 @pytest.fixture
 def config_with_css(tempdir):
     with open("%s/test.css" % tempdir, "w") as f:
@@ -171,8 +163,47 @@ def test_headers_when_multipart_signed(basic_config):
     assert signature_part.get_content_type() == "application/pgp-signature"
 
 
+def test_move_headers_repeated():
+    source = MIMEText("body")
+    source["Received"] = "from a by b"
+    source["Subject"] = "Test Message"
+    source["Bcc"] = "bananas"
+    source["Received"] = "from b by c"
+    source["Content-Disposition"] = "inline"
+    source["Received"] = "from c by d"
+    dest = MIMEMultipart("alternative")
+
+    _move_headers(source, dest)
+
+    assert source.items() == [
+        ("Content-Type", 'text/plain; charset="us-ascii"'),
+        ("MIME-Version", "1.0"),
+        ("Content-Transfer-Encoding", "7bit"),
+        ("Content-Disposition", "inline"),
+    ]
+    assert dest.items()[2:] == [
+        ("Received", "from a by b"),
+        ("Subject", "Test Message"),
+        ("Received", "from b by c"),
+        ("Received", "from c by d"),
+    ]
+
+
+def test_move_headers_many():
+    source = MIMEText("body")
+    for i in range(5000):
+        source["Received"] = "hop %d" % i
+    dest = MIMEMultipart("alternative")
+
+    _move_headers(source, dest)
+
+    assert source.get_all("Received") is None
+    assert dest.get_all("Received") == ["hop %d" % i for i in range(5000)]
+
+
 class MockSmtpServer(object):
-    def __init__(self):
+    def __init__(self, greeting=b"220 localhost SMTP Fake"):
+        self.greeting = greeting
         self._s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._s.bind(("127.0.0.1", 0))
         self.address = self._s.getsockname()[0:2]
@@ -205,7 +236,10 @@ class MockSmtpServer(object):
                 conn, addr = self._s.accept()
                 conn = context.wrap_socket(conn, server_side=True)
                 message = b""
-                conn.sendall(b"220 localhost SMTP Fake\r\n")
+                conn.sendall(self.greeting + b"\r\n")
+                if not self.greeting.startswith(b"220"):
+                    conn.close()
+                    continue
                 message += conn.recv(1024)
                 conn.sendall(b"250-localhost\r\n250 DSN\r\n")
                 # MAIL FROM
@@ -246,6 +280,25 @@ def smtp_server():
         s.stop()
 
 
+@pytest.fixture
+def busy_smtp_server():
+    s = MockSmtpServer(greeting=b"421 localhost Too busy")
+    s.start()
+    try:
+        yield s
+    finally:
+        s.stop()
+
+
+@pytest.fixture
+def closed_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    address = s.getsockname()[0:2]
+    s.close()
+    return address
+
+
 def test_main_smtplib(tempdir, smtp_server, mocker):
     config_path = os.path.join(tempdir, "config.yaml")
     with open(config_path, "w") as f:
@@ -272,6 +325,150 @@ def test_main_smtplib(tempdir, smtp_server, mocker):
     assert b"no sigil" in transcript
 
 
+def test_main_smtp_failover(
+    tempdir, smtp_server, busy_smtp_server, closed_port, mocker
+):
+    config_path = os.path.join(tempdir, "config.yaml")
+    state_path = os.path.join(tempdir, "relays.json")
+    with open(config_path, "w") as f:
+        yaml.dump(
+            {
+                "smtp_relays": [
+                    {"host": closed_port[0], "port": closed_port[1], "priority": 0},
+                    {
+                        "host": busy_smtp_server.address[0],
+                        "port": busy_smtp_server.address[1],
+                        "priority": 1,
+                    },
+                    {
+                        "host": smtp_server.address[0],
+                        "port": smtp_server.address[1],
+                        "priority": 2,
+                    },
+                ],
+                "smtp_relay_state_file": state_path,
+                "smtp_ssl": True,
+            },
+            f,
+        )
+    msg = Message()
+    msg["Subject"] = "Test Message"
+    msg.set_payload("This message has no sigil")
+    mocker.patch.object(main, "read_message", return_value=msg.as_string())
+    main.main(["-c", config_path, "-f", "from@example.com", "to@example.com"])
+
+    assert len(smtp_server.messages) == 1
+    assert b"Subject: Test Message" in smtp_server.messages[0][1]
+
+    with open(state_path) as f:
+        state = json.load(f)
+    down = state["%s:%s" % closed_port]
+    busy = state["%s:%s" % busy_smtp_server.address]
+    good = state["%s:%s" % smtp_server.address]
+    assert down["failures"] == 1
+    assert down["backoff_until"] > time.time()
+    assert busy["failures"] == 1
+    assert good["failures"] == 0
+    assert good["latency"] is not None
+
+    # the failed relays are backed off from, so the next send goes
+    # straight to the healthy one
+    mocker.patch.object(main, "smtp_connection", wraps=main.smtp_connection)
+    main.main(["-c", config_path, "-f", "from@example.com", "to@example.com"])
+    assert len(smtp_server.messages) == 2
+    assert main.smtp_connection.call_count == 1
+
+
+def _relay_pool(*hosts):
+    return RelayPool(
+        [Relay(host, 25, priority=i) for i, host in enumerate(hosts)],
+        rng=random.Random(0),
+    )
+
+
+def test_send_smtp_fails_over_on_4xx(basic_config, mocker):
+    busy = mocker.Mock()
+    busy.sendmail.side_effect = smtplib.SMTPDataError(451, b"try again later")
+    good = mocker.Mock()
+    mocker.patch.object(main, "smtp_connection", side_effect=[busy, good])
+    pool = _relay_pool("busy", "good")
+
+    relay = main.send_smtp(
+        basic_config, "from@example.com", ["to@example.com"], b"", pool=pool
+    )
+    assert relay.host == "good"
+    good.sendmail.assert_called_once()
+    busy.close.assert_called_once()
+    assert pool.relays[0].failures == 1
+    assert pool.relays[1].failures == 0
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        socket.timeout("timed out"),
+        smtplib.SMTPServerDisconnected("Connection unexpectedly closed"),
+        smtplib.SMTPDataError(554, b"rejected"),
+    ],
+)
+def test_send_smtp_no_failover_during_transaction(basic_config, mocker, error):
+    slow = mocker.Mock()
+    slow.sendmail.side_effect = error
+    connect = mocker.patch.object(main, "smtp_connection", return_value=slow)
+    pool = _relay_pool("slow", "other")
+
+    with pytest.raises(type(error)):
+        main.send_smtp(
+            basic_config, "from@example.com", ["to@example.com"], b"", pool=pool
+        )
+    # the first relay may have accepted the message, so it must not be
+    # sent again through the second one
+    assert connect.call_count == 1
+    # the transaction gets everything that's left of smtp_timeout
+    (data_timeout,), _ = slow.sock.settimeout.call_args
+    assert data_timeout > basic_config.smtp_timeout * 0.9
+
+
+@pytest.mark.parametrize("username", ["", "user"])
+def test_send_smtp_fails_over_during_setup(basic_config, mocker, username):
+    basic_config.merge_config(
+        {"smtp_ssl": False, "smtp_username": username, "smtp_password": "pw"}
+    )
+    broken = mocker.Mock()
+    if username:
+        broken.login.side_effect = smtplib.SMTPAuthenticationError(
+            454, b"Temporary authentication failure"
+        )
+    else:
+        broken.starttls.side_effect = smtplib.SMTPNotSupportedError(
+            "STARTTLS extension not supported by server."
+        )
+    good = mocker.Mock()
+    mocker.patch.object(smtplib, "SMTP", side_effect=[broken, good])
+    pool = _relay_pool("broken", "good")
+
+    relay = main.send_smtp(
+        basic_config, "from@example.com", ["to@example.com"], b"", pool=pool
+    )
+    assert relay.host == "good"
+    # the half-set-up connection is closed before failing over
+    broken.close.assert_called_once()
+    broken.sendmail.assert_not_called()
+    good.sendmail.assert_called_once()
+    good.close.assert_not_called()
+
+
+def test_send_smtp_unwritable_state_file(basic_config, tempdir, mocker, capsys):
+    state_path = os.path.join(tempdir, "missing", "relays.json")
+    basic_config.merge_config({"smtp_relay_state_file": state_path})
+    conn = mocker.Mock()
+    mocker.patch.object(main, "smtp_connection", return_value=conn)
+
+    main.send_smtp(basic_config, "from@example.com", ["to@example.com"], b"")
+    conn.sendmail.assert_called_once()
+    assert "Unable to save SMTP relay state" in capsys.readouterr().err
+
+
 def test_main_passthru(tempdir, mocker):
     output_path = os.path.join(tempdir, "output")
     sendmail_path = os.path.join(tempdir, "sendmail")
@@ -322,3 +519,124 @@ def test_assume_markdown(basic_config):
     converted = process_message(msg, basic_config)
     html_part = converted.get_payload()[1].get_payload(decode=True)
     assert html_part == b"<p>This message has no <strong>sigil</strong></p>"
+
+
+def test_very_wide_message(basic_config):
+    msg = MIMEMultipart()
+    msg["Subject"] = "Test Message"
+    for i in range(10000):
+        if i % 1000 == 0:
+            msg.attach(MIMEText("!m part %d" % i))
+        else:
+            msg.attach(MIMEText("part %d" % i))
+
+    converted, did_conversion = convert_tree(msg, basic_config)
+    assert did_conversion
+    assert converted["Subject"] == "Test Message"
+    parts = converted.get_payload()
+    assert len(parts) == 10000
+    assert parts[0].get_content_type() == "multipart/alternative"
+    assert parts[0].get_payload()[1].get_payload(decode=True) == b"<p>part 0</p>"
+    assert parts[1].get_content_type() == "text/plain"
+    assert parts[1].get_payload() == "part 1"
+    assert parts[9999].get_payload() == "part 9999"
+
+
+def test_very_deep_message(basic_config):
+    msg = MIMEText("!m the innermost part")
+    for i in range(1000):
+        outer = MIMEMultipart()
+        outer.attach(msg)
+        msg = outer
+    msg["Subject"] = "Test Message"
+
+    # far deeper than the email package can parse or serialize, but
+    # convert_tree itself has no trouble with it
+    basic_config.merge_config({"max_mime_depth": 1000})
+    converted, did_conversion = convert_tree(msg, basic_config)
+    assert did_conversion
+    assert converted["Subject"] == "Test Message"
+    depth = 0
+    part = converted
+    while part.get_content_type() == "multipart/mixed":
+        assert len(part.get_payload()) == 1
+        part = part.get_payload()[0]
+        depth += 1
+    assert depth == 1000
+    assert part.get_content_type() == "multipart/alternative"
+    html_part = part.get_payload()[1]
+    assert html_part.get_payload(decode=True) == b"<p>the innermost part</p>"
+
+
+def _nested_message(depth):
+    body = "Content-Type: text/plain\n\n!m innermost\n"
+    for i in range(depth):
+        boundary = "boundary%d" % i
+        body = 'Content-Type: multipart/mixed; boundary="%s"\n\n--%s\n%s\n--%s--\n' % (
+            boundary,
+            boundary,
+            body,
+            boundary,
+        )
+    return (
+        "Subject: Test Message\nBcc: secret@example.com,\n other@example.com\n"
+        "MIME-Version: 1.0\n" + body
+    )
+
+
+@pytest.mark.parametrize("depth", [Config._parameters["max_mime_depth"], 150, 300])
+def test_main_deep_message(depth, tempdir, mocker, capsys):
+    config_path = os.path.join(tempdir, "config.yaml")
+    with open(config_path, "w") as f:
+        yaml.dump({}, f)
+    raw = _nested_message(depth)
+    mocker.patch.object(main, "read_message", return_value=raw)
+    rv = main.main(
+        ["-c", config_path, "-f", "from@example.com", "-p", "to@example.com"]
+    )
+    assert rv == 0
+
+    out = capsys.readouterr().out
+    assert "Subject: Test Message" in out
+    assert "!m innermost" in out
+    assert "example.com" not in out
+    if depth <= Config._parameters["max_mime_depth"]:
+        assert "Content-Type: text/html" in out
+    else:
+        # passed through byte-for-byte, apart from the Bcc header
+        assert (
+            out
+            == raw.replace("Bcc: secret@example.com,\n other@example.com\n", "") + "\n"
+        )
+
+
+def test_strip_bcc():
+    assert main._strip_bcc(
+        "Subject: hi\r\nBCC: a@example.com,\r\n\tb@example.com\r\n"
+        "To: c@example.com\r\n\r\nBcc: in the body\r\n"
+    ) == ("Subject: hi\r\nTo: c@example.com\r\n\r\nBcc: in the body\r\n")
+
+
+def test_mime_limits_pass_through(basic_config):
+    msg = MIMEMultipart()
+    msg["Subject"] = "Test Message"
+    inner = MIMEMultipart()
+    inner.attach(MIMEText("!m This is the main message body"))
+    msg.attach(inner)
+    msg.attach(MIMEText("!m another part"))
+
+    basic_config.merge_config({"max_mime_depth": 1})
+    converted, did_conversion = convert_tree(msg, basic_config)
+    assert not did_conversion
+    assert converted is msg
+    assert converted["Subject"] == "Test Message"
+
+    basic_config.merge_config({"max_mime_depth": 2, "max_mime_parts": 3})
+    converted, did_conversion = convert_tree(msg, basic_config)
+    assert not did_conversion
+    assert converted is msg
+
+    basic_config.merge_config({"max_mime_parts": 4})
+    converted, did_conversion = convert_tree(msg, basic_config)
+    assert did_conversion
+    assert converted is not msg
@@ -1,6 +1,8 @@
 import tempfile
 
-from muttdown.config import Config
+import pytest
+
+from muttdown.config import Config, ConfigError
 
 
 def test_smtp_password_literal():
@@ -32,3 +34,38 @@ def test_assume_markdown():
     assert not c.assume_markdown
     c.merge_config({"assume_markdown": True})
     assert c.assume_markdown
+
+
+def test_smtp_relays():
+    c = Config()
+    c.merge_config({"smtp_host": "smtp.example.com", "smtp_port": 465})
+    assert c.smtp_relays == [
+        {"host": "smtp.example.com", "port": 465, "weight": 1, "priority": 0}
+    ]
+
+    c.merge_config(
+        {
+            "smtp_relays": [
+                {"host": "a.example.com", "weight": 3},
+                {"host": "b.example.com", "port": 587, "priority": 10},
+            ]
+        }
+    )
+    assert c.smtp_relays == [
+        {"host": "a.example.com", "port": 465, "weight": 3, "priority": 0},
+        {"host": "b.example.com", "port": 587, "weight": 1, "priority": 10},
+    ]
+
+
+def test_smtp_relays_invalid():
+    for relays in (
+        [],
+        [{"port": 25}],
+        [{"host": "a.example.com", "weight": 0}],
+        [{"host": "a.example.com", "bananas": 1}],
+        [{"host": "a.example.com", "priority": "high"}],
+        [{"host": "a.example.com", "port": "smtp"}],
+        [{"host": "a.example.com", "port": 25.5}],
+    ):
+        with pytest.raises(ConfigError):
+            Config().merge_config({"smtp_relays": relays})
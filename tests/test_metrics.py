@@ -0,0 +1,185 @@
+import json
+import os
+import re
+from email.message import Message
+
+import pytest
+import yaml
+
+from muttdown import main, metrics
+from muttdown.metrics import Registry
+
+
+@pytest.fixture(autouse=True)
+def clean_registry():
+    metrics.registry.reset()
+    yield
+    metrics.registry.reset()
+
+
+def assert_prometheus_text(text):
+    """Check that every sample belongs to the family declared by the
+    preceding TYPE line, which is how the Prometheus text parser used by
+    node-exporter's textfile collector assigns types."""
+    sample_re = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$")
+    suffixes = {
+        "counter": ("",),
+        "histogram": ("_bucket", "_sum", "_count"),
+    }
+    family = kind = None
+    seen = set()
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            _, _, family, kind = line.split(" ")
+            assert family not in seen
+            seen.add(family)
+        elif line.startswith("# HELP "):
+            assert line.split(" ")[2] not in seen
+        else:
+            match = sample_re.match(line)
+            assert match, line
+            assert family is not None, line
+            assert match.group(1) in [family + s for s in suffixes[kind]], line
+            float(match.group(3))
+
+
+def test_render_counters_and_histograms():
+    r = Registry(buckets=(0.1, 1.0))
+    r.inc("muttdown_messages")
+    r.inc("muttdown_messages")
+    r.inc("muttdown_bytes", 100, direction="in")
+    r.observe("muttdown_stage_duration_seconds", 0.5, stage="conversion")
+    r.observe("muttdown_stage_duration_seconds", 0.05, stage="conversion")
+    rendered = r.render()
+    lines = rendered.splitlines()
+    assert "# TYPE muttdown_messages_total counter" in lines
+    assert "muttdown_messages_total 2" in lines
+    assert 'muttdown_bytes_total{direction="in"} 100' in lines
+    assert "# TYPE muttdown_stage_duration_seconds histogram" in lines
+    assert (
+        'muttdown_stage_duration_seconds_bucket{stage="conversion",le="0.1"} 1' in lines
+    )
+    assert (
+        'muttdown_stage_duration_seconds_bucket{stage="conversion",le="1.0"} 2' in lines
+    )
+    assert (
+        'muttdown_stage_duration_seconds_bucket{stage="conversion",le="+Inf"} 2'
+        in lines
+    )
+    assert 'muttdown_stage_duration_seconds_count{stage="conversion"} 2' in lines
+    assert 'muttdown_stage_duration_seconds_sum{stage="conversion"} 0.55' in lines
+    assert_prometheus_text(rendered)
+
+
+def test_write_textfile_accumulates(tempdir):
+    path = os.path.join(tempdir, "muttdown.prom")
+    metrics.inc("muttdown_messages")
+    metrics.observe("muttdown_stage_duration_seconds", 0.2, stage="smtp_data")
+    metrics.write_textfile(path)
+    # the in-process registry is drained after every write
+    assert metrics.registry.counters == {}
+
+    metrics.inc("muttdown_messages")
+    metrics.observe("muttdown_stage_duration_seconds", 0.3, stage="smtp_data")
+    metrics.write_textfile(path)
+
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert "muttdown_messages_total 2" in lines
+    assert 'muttdown_stage_duration_seconds_count{stage="smtp_data"} 2' in lines
+    with open(path + ".json") as f:
+        state = json.load(f)
+    assert state["counters"] == [
+        {"name": "muttdown_messages", "labels": {}, "value": 2}
+    ]
+
+
+def test_main_records_metrics(tempdir, mocker):
+    prom_path = os.path.join(tempdir, "muttdown.prom")
+    config_path = os.path.join(tempdir, "config.yaml")
+    with open(config_path, "w") as f:
+        yaml.dump({"metrics_file": prom_path}, f)
+
+    msg = Message()
+    msg["Subject"] = "Test Message"
+    msg["From"] = "from@example.com"
+    msg["To"] = "to@example.com"
+    msg.set_payload("!m This is **markdown**")
+    mocker.patch.object(main, "read_message", return_value=msg.as_string())
+    main.main(["-c", config_path, "-f", "from@example.com", "-p", "to@example.com"])
+
+    with open(prom_path) as f:
+        lines = f.read().splitlines()
+    assert "muttdown_messages_total 1" in lines
+    assert 'muttdown_parts_total{action="converted"} 1' in lines
+    assert 'muttdown_bytes_total{direction="in"} %d' % len(msg.as_string()) in lines
+    assert 'muttdown_stage_duration_seconds_count{stage="conversion"} 1' in lines
+
+
+def test_main_records_sendmail_errors(tempdir, mocker):
+    prom_path = os.path.join(tempdir, "muttdown.prom")
+    config_path = os.path.join(tempdir, "config.yaml")
+    with open(config_path, "w") as f:
+        yaml.dump({"metrics_file": prom_path, "sendmail": "false"}, f)
+
+    msg = Message()
+    msg["Subject"] = "Test Message"
+    msg.set_payload("This message has no sigil")
+    mocker.patch.object(main, "read_message", return_value=msg.as_string())
+    rv = main.main(
+        ["-c", config_path, "-f", "from@example.com", "-s", "to@example.com"]
+    )
+    assert rv == 1
+
+    with open(prom_path) as f:
+        lines = f.read().splitlines()
+    assert 'muttdown_parts_total{action="passthrough"} 1' in lines
+    assert 'muttdown_delivery_errors_total{code="1",method="sendmail"} 1' in lines
+
+
+def test_render_registry_with_every_metric():
+    r = Registry()
+    for family, (kind, _) in metrics.METRICS.items():
+        if kind == "counter":
+            r.inc(family, label='needs "escaping"')
+        else:
+            r.observe(family, 0.1, stage="conversion")
+    assert_prometheus_text(r.render())
+
+
+@pytest.mark.parametrize(
+    "contents",
+    [
+        '{"counters": [{"name": "x"}]}',
+        '{"counters": [{"name": "x", "labels": {}, "value": "bananas"}]}',
+        '{"histograms": [{"name": "x"}]}',
+        "[]",
+        "not json {",
+    ],
+)
+def test_write_textfile_malformed_state(tempdir, contents):
+    path = os.path.join(tempdir, "muttdown.prom")
+    with open(path + ".json", "w") as f:
+        f.write(contents)
+    metrics.inc("muttdown_messages")
+    metrics.write_textfile(path)
+
+    with open(path) as f:
+        assert "muttdown_messages_total 1" in f.read().splitlines()
+    # the bad state is replaced, so the next run starts from good state
+    with open(path + ".json") as f:
+        assert Registry.from_state(json.load(f)).counters == {
+            ("muttdown_messages", ()): 1
+        }
+
+
+def test_main_ignores_metrics_errors(tempdir, mocker):
+    config_path = os.path.join(tempdir, "config.yaml")
+    with open(config_path, "w") as f:
+        yaml.dump({"metrics_file": os.path.join(tempdir, "missing", "m.prom")}, f)
+    mocker.patch.object(main, "read_message", return_value="Subject: hi\n\nhello\n")
+    mocker.patch.object(metrics, "write_textfile", side_effect=KeyError("x"))
+    rv = main.main(
+        ["-c", config_path, "-f", "from@example.com", "-p", "to@example.com"]
+    )
+    assert rv == 0
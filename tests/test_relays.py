@@ -0,0 +1,128 @@
+import json
+import random
+
+import pytest
+
+from muttdown.relays import Relay, RelayPool
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_candidates_by_priority():
+    relays = [
+        Relay("backup", 25, priority=10),
+        Relay("primary-a", 25, priority=0),
+        Relay("primary-b", 25, priority=0),
+    ]
+    pool = RelayPool(relays, rng=random.Random(0))
+    for _ in range(20):
+        hosts = [r.host for r in pool.candidates()]
+        assert sorted(hosts[:2]) == ["primary-a", "primary-b"]
+        assert hosts[2] == "backup"
+
+
+def test_candidates_prefer_healthy_relays():
+    slow = Relay("slow", 25)
+    slow.record_latency(2.0)
+    flaky = Relay("flaky", 25)
+    for _ in range(5):
+        flaky.record_failure(0, 0)
+    fast = Relay("fast", 25)
+    fast.record_latency(0.01)
+    pool = RelayPool([slow, flaky, fast], rng=random.Random(0))
+    first = [pool.candidates()[0].host for _ in range(200)]
+    assert first.count("fast") > 130
+    assert first.count("flaky") < 50
+    assert first.count("slow") < 40
+
+
+def test_candidates_weights():
+    heavy = Relay("heavy", 25, weight=9)
+    light = Relay("light", 25, weight=1)
+    pool = RelayPool([heavy, light], rng=random.Random(0))
+    first = [pool.candidates()[0].host for _ in range(1000)]
+    assert 850 < first.count("heavy") < 950
+
+
+def test_backoff():
+    clock = FakeClock()
+    a = Relay("a", 25, priority=0)
+    b = Relay("b", 25, priority=1)
+    pool = RelayPool([a, b], backoff=30, clock=clock)
+    assert pool.candidates() == [a, b]
+
+    pool.record_failure(a)
+    assert pool.candidates() == [b, a]
+    clock.now += 31
+    assert pool.candidates() == [a, b]
+
+    # consecutive failures back off for longer
+    pool.record_failure(a)
+    clock.now += 31
+    assert pool.candidates() == [b, a]
+    clock.now += 30
+    assert pool.candidates() == [a, b]
+
+    a.record_success()
+    pool.record_failure(a)
+    assert a.backoff_until == clock.now + 30
+
+
+def test_state_round_trip(tmpdir):
+    path = str(tmpdir.join("relays.json"))
+    a = Relay("a", 25)
+    a.record_latency(0.5)
+    a.record_failure(1000, 30)
+    RelayPool([a, Relay("b", 25)]).save_state(path)
+
+    a2 = Relay("a", 25)
+    b2 = Relay("b", 25)
+    RelayPool([a2, b2]).load_state(path)
+    assert a2.to_state() == a.to_state()
+    assert b2.failures == 0
+    assert b2.latency is None
+
+
+def test_backoff_many_failures():
+    relay = Relay("a", 25)
+    relay.failures = 5000
+    relay.record_failure(1000, 30.5)
+    assert relay.backoff_until == 1000 + 600
+
+
+@pytest.mark.parametrize(
+    "contents",
+    [
+        {"a:25": {"latency": "fast"}},
+        {"a:25": {"latency": -1}},
+        {"a:25": {"backoff_until": None}},
+        {"a:25": {"error_rate": 2}},
+        {"a:25": {"error_rate": "0.5"}},
+        {"a:25": {"failures": -1}},
+        {"a:25": {"failures": True}},
+        {"a:25": {"failures": 1.5}},
+        {"a:25": "bananas"},
+        [],
+    ],
+)
+def test_malformed_state(tmpdir, contents):
+    path = str(tmpdir.join("relays.json"))
+    with open(path, "w") as f:
+        json.dump(contents, f)
+
+    pool = RelayPool([Relay("a", 25), Relay("b", 25)])
+    pool.load_state(path)
+    assert len(pool.candidates()) == 2
+    assert pool.relays[0].to_state() == Relay("a", 25).to_state()
+
+    # the bad entry is replaced, so the next run starts from good state
+    pool.save_state(path)
+    pool = RelayPool([Relay("a", 25)])
+    pool.load_state(path)
+    assert pool.relays[0].to_state() == Relay("a", 25).to_state()